@@ -1,25 +1,33 @@
 import math
 import numpy as np
-import os
-import scipy.signal as sc_signal
-import tempfile
-import wfdb
 from wfdb import processing
 import multiprocessing
 
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:  # numba is optional, the jqrs kernels then run as plain numpy/python
+    HAS_NUMBA = False
+
+    def njit(*args, **kwargs):
+        return lambda func: func
+
 from pecg._ErrorHandler import _check_shape_, WrongParameter
 from pecg.ecg.c_files.EpltdAll import epltd_all
 from pecg.ecg.wavedet_exe.Wavdet import wavdet
 
+MAX_BPM = 300  # upper bound on the heart rate, used to preallocate the peaks of all the leads
+
 
 class FiducialPoints:
 
-    def __init__(self, signal: np.array, fs: int):
+    def __init__(self, signal: np.array, fs: int, n_pools: int = 1):
         """
         The purpose of the FiducialPoints class is to calculate the fiducial points.
 
         :param signal: the ECG signal as a ndarray, with shape (L, N) when L is the number of channels or leads and N is the number of samples.
         :param fs: The sampling frequency of the signal.[Hz]
+        :param n_pools: number of processes used to run the peak detectors on the leads in parallel, default value is 1 (serial).
 
         .. code-block:: python
         
@@ -37,8 +45,17 @@ class FiducialPoints:
 
         self.signal = signal
         self.fs = fs
+        self.n_pools = n_pools
         self.peaks = []
 
+    @property
+    def signal(self):
+        return self._signal
+
+    @signal.setter
+    def signal(self, signal):
+        self._signal = signal
+        self._epltd_peaks = None  # the cached epltd peaks belong to the previous signal
 
     def wavedet(self, matlab_pat: str, peaks: np.array = np.array([])):
         """
@@ -63,57 +80,47 @@ class FiducialPoints:
         signal = self.signal
         fs = self.fs
 
-        try:
-            cwd = os.getcwd()
-            fl = 1
-        except:
-            print('Not exists current path')
-            fl = 0
-
         if len(np.shape(signal)) == 2:
             [ecg_len, ecg_num] = np.shape(signal)
         elif len(np.shape(signal)) == 1:
             ecg_num = 1
         if peaks.size == 0:
-            peaks = self.epltd
+            peaks = self.epltd()
 
         self.peaks = peaks
 
         fiducials_mat, tempdirname = wavdet(signal, fs, peaks, matlab_pat)
-        keys = ["Pon", "P", "Poff", "QRSon", "qrs", "QRSoff", "Ton", "T", "Toff"]
+        keys = frozenset(["Pon", "P", "Poff", "QRSon", "qrs", "QRSoff", "Ton", "T", "Toff"])
         position = fiducials_mat['output']
         all_keys = fiducials_mat['output'].dtype.names
         fiducials = {}
 
         num_ecg = np.size(position)
         for j in np.arange(num_ecg):
+            lead_position = position[0, j]
             position_values = []
             position_keys = []
             for i, key in enumerate(all_keys):
-                ret_val = position[0, j][i].squeeze()
-                if (keys.__contains__(key)):
-                    if len(ret_val[np.isnan(ret_val)]):
-                        ret_val[np.isnan(ret_val)] = np.nan
-                    ret_val = np.asarray(ret_val)
+                if key in keys:
+                    ret_val = np.asarray(lead_position[i].squeeze())
                     position_values.append(ret_val)
                     position_keys.append(key)
             # -----------------------------------
 
             fiducials[j] = dict(zip(position_keys, position_values))
-        if fl:
-            os.chdir(cwd)
         tempdirname.cleanup()
         return fiducials
 
     def epltd(self):
         """
         This function calculates the indexes of the R-peaks with epltd peak detector algorithm.
-        This algorithm were introduced by [2]_.
+        This algorithm were introduced by [2]_. The peaks are computed once and cached until a new signal is assigned
+        to fp.signal, so in-place edits of the signal array are not seen by later calls.
 
         .. [2] Pan, Jiapu, and Willis J. Tompkins. "A real-time QRS detection algorithm."
             IEEE Trans. Biomed. Eng 32.3 (1985): 230-236.
 
-        :return: indexes of the R-peaks in the ECG signal, as an ndarray of shape (L,N), when L is the number of channels or leads and N is the number of peaks.
+        :return: indexes of the R-peaks in the ECG signal, as an ndarray of shape (L,N), when L is the number of channels or leads and N is the number of peaks. Leads with fewer peaks are padded with NaN.
 
 
         .. code-block:: python
@@ -121,40 +128,26 @@ class FiducialPoints:
             peaks = fp.epltd()
 
         """
-        try:
-            cwd = os.getcwd()
-            fl = 1
-        except:
-            fl = 0
+        if self._epltd_peaks is not None:
+            return self._epltd_peaks
 
         signal = self.signal
         fs = self.fs
 
         if len(np.shape(signal)) == 2:
-            [ecg_len, ecg_num] = np.shape(signal)
-            size_peaks = np.zeros([1, ecg_num]).squeeze()
-            peaks_dict = {}
-            for i in np.arange(0, ecg_num):
-                peaks_dict[str(i)] = epltd_all(signal[:, i], fs)
-                size_peaks[i] = len(peaks_dict[str(i)])
-            max_sp = int(np.max(size_peaks))
-            peaks = np.zeros([max_sp, ecg_num])
-            for i in np.arange(0, ecg_num):
-                peaks[:int(size_peaks[i]), i] = peaks_dict[str(i)]
+            peaks = self.__peaks_per_lead(epltd_all)
         elif len(np.shape(signal)) == 1:
             ecg_num = 1
             peaks = epltd_all(signal, fs)
 
-        if fl:
-            os.chdir(cwd)
-
+        self._epltd_peaks = peaks
         return peaks
 
     def xqrs(self):
         """
         This function wraps the XQRS function of the WFDB package.
 
-        :return: indexes of the R-peaks in the ECG signal, as an ndarray of shape (L,N), when L is the number of channels or leads and N is the number of peaks.
+        :return: indexes of the R-peaks in the ECG signal, as an ndarray of shape (L,N), when L is the number of channels or leads and N is the number of peaks. Leads with fewer peaks are padded with NaN.
 
 
         .. code-block:: python
@@ -166,20 +159,10 @@ class FiducialPoints:
         fs = self.fs
 
         if len(np.shape(signal)) == 2:
-            [ecg_len, ecg_num] = np.shape(signal)
-            size_peaks = np.zeros([1, ecg_num]).squeeze()
-            peaks_dict = {}
-            for i in np.arange(0, ecg_num):
-                signali = signal[:, i]
-                peaks_dict[str(i)] = self.__calculate_xqrs(signali, fs)
-                size_peaks[i] = len(peaks_dict[str(i)])
-            max_sp = int(np.max(size_peaks))
-            peaks = np.zeros([max_sp, ecg_num])
-            for i in np.arange(0, ecg_num):
-                peaks[:int(size_peaks[i]), i] = peaks_dict[str(i)]
+            peaks = self.__peaks_per_lead(_calculate_xqrs)
         elif len(np.shape(signal)) == 1:
             ecg_num = 1
-            peaks = self.__calculate_xqrs(signal, fs)
+            peaks = _calculate_xqrs(signal, fs)
         self.peaks = peaks
         return peaks
 
@@ -198,7 +181,7 @@ class FiducialPoints:
         :param thr: threshold, default value is 0.8.
         :param rp: refractory period (sec), default value is 0.25.
 
-        :return: indexes of the R-peaks in the ECG signal, as an ndarray of shape (L,N), when L is the number of channels or leads and N is the number of peaks.
+        :return: indexes of the R-peaks in the ECG signal, as an ndarray of shape (L,N), when L is the number of channels or leads and N is the number of peaks. Leads with fewer peaks are padded with NaN.
 
 
         .. code-block:: python
@@ -209,129 +192,183 @@ class FiducialPoints:
         signal = self.signal
         fs = self.fs
         if len(np.shape(signal)) == 2:
-            [ecg_len, ecg_num] = np.shape(signal)
-            size_peaks = np.zeros([1, ecg_num]).squeeze()
-            peaks_dict = {}
-            for i in np.arange(0, ecg_num):
-                signali = signal[:, i]
-                peaks_dict[str(i)] = self.__calculate_jqrs(signali, fs, thr, rp)
-                size_peaks[i] = len(peaks_dict[str(i)])
-            max_sp = int(np.max(size_peaks))
-            peaks = np.zeros([max_sp, ecg_num])
-            for i in np.arange(0, ecg_num):
-                peaks[:int(size_peaks[i]), i] = peaks_dict[str(i)]
+            peaks = self.__peaks_per_lead(_calculate_jqrs, thr, rp)
         elif len(np.shape(signal)) == 1:
             ecg_num = 1
-            peaks = self.__calculate_jqrs(signal, fs, thr, rp)
+            peaks = _calculate_jqrs(signal, fs, thr, rp)
         self.peaks = peaks
         return peaks
 
-    @staticmethod
-    def __calculate_xqrs(signal, fs):
-        try:
-            cwd = os.getcwd()
-            fl = 1
-        except:
-            print('Not exists current path')
-            fl = 0
-        tmpdirname = tempfile.TemporaryDirectory()
-        os.chdir(tmpdirname.name)
-        wfdb.wrsamp(record_name='temp', fs=fs, units=['mV'], sig_name=['V5'],
-                    p_signal=signal.reshape(-1, 1), fmt=['16'])
-        record = wfdb.rdrecord(tmpdirname.name + '/temp')
-        ecg = record.p_signal[:, 0]
-        xqrs = processing.xqrs_detect(ecg, fs=fs)
-
-        if fl:
-            os.chdir(cwd)
-        tmpdirname.cleanup()
-        return xqrs
-
-
-    @staticmethod
-    def __calculate_jqrs(signal, fs, thr, rp):
-        try:
-            cwd = os.getcwd()
-            fl = 1
-        except:
-            print('Not exists current path')
-            fl = 0
-        tmpdirname =  tempfile.TemporaryDirectory()
-        os.chdir(str(tmpdirname.name))
-        wfdb.wrsamp(record_name='temp', fs=fs, units=['mV'], sig_name=['V5'],
-                    p_signal=signal.reshape(-1, 1), fmt=['16'])
-        record = wfdb.rdrecord(tmpdirname.name + '/temp')
-        ecg = record.p_signal[:, 0]
-        INT_NB_COEFF = int(np.round(7 * fs / 256))  # length is 30 for fs=256Hz
-        dffecg = np.diff(ecg)  # differenciate (one datapoint shorter)
-        sqrecg = np.square(dffecg)  # square ecg
-        intecg = sc_signal.lfilter(np.ones(INT_NB_COEFF, dtype=int),
-                                   1, sqrecg)  # integrate
-        mdfint = intecg
-        delay = math.ceil(INT_NB_COEFF / 2)
-        mdfint = np.roll(mdfint, -delay)  # remove filter delay for scanning back through ecg
-        # thresholding
-        mdfint_temp = mdfint
-        mdfint_temp_ = np.delete(mdfint_temp, np.where(ecg == -32768))  # exclude the NaN (encoded in WFDB format)
-        xs = np.sort(mdfint_temp)
-        ind_xs = int(np.round(98 / 100 * len(xs)))
-        en_thres = xs[ind_xs]
-        poss_reg = mdfint > thr * en_thres
-        tm = np.arange(start=1 / fs, stop=(len(ecg) + 1) / fs, step=1 / fs).reshape(1, -1)
-        # search back
-        SEARCH_BACK = 1
-        if SEARCH_BACK:
-            indAboveThreshold = np.where(poss_reg)[0]  # indices of samples above threshold
-            RRv = np.diff(tm[0, indAboveThreshold])  # compute RRv
-            medRRv = np.median(RRv[RRv > 0.01])
-            indMissedBeat = np.where(RRv > 1.5 * medRRv)[0]  # missed a peak?
-            # find interval onto which a beat might have been missed
-            indStart = indAboveThreshold[indMissedBeat]
-            indEnd = indAboveThreshold[indMissedBeat + 1]
-            for i in range(0, len(indStart)):
-                # look for a peak on this interval by lowering the energy threshold
-                poss_reg[indStart[i]: indEnd[i]] = mdfint[indStart[i]: indEnd[i]] > (0.25 * thr * en_thres)
-        # find indices into boudaries of each segment
-        left = np.where(np.diff(np.pad(1 * poss_reg, (1, 0), 'constant')) == 1)[0]  # remember to zero pad at start
-        right = np.where(np.diff(np.pad(1 * poss_reg, (0, 1), 'constant')) == -1)[0]  # remember to zero pad at end
-        nb_s = len(left < 30 * fs)
-        loc = np.zeros([1, nb_s], dtype=int)
-        for j in range(0, nb_s):
-            loc[0, j] = np.argmax(np.abs(ecg[left[j]:right[j] + 1]))
-            loc[0, j] = int(loc[0, j] + left[j])
-        sign = np.median(ecg[loc])
-        # loop through all possibilities
-        compt = 0
-        NB_PEAKS = len(left)
-        maxval = np.zeros([NB_PEAKS])
-        maxloc = np.zeros([NB_PEAKS], dtype=int)
-        for j in range(0, NB_PEAKS):
-            if sign > 0:
-                # if sign is positive then look for positive peaks
-                maxval[compt] = np.max(ecg[left[j]:right[j] + 1])
-                maxloc[compt] = np.argmax(ecg[left[j]:right[j] + 1])
-            else:
-                # if sign is negative then look for negative peaks
-                maxval[compt] = np.min(ecg[left[j]:right[j] + 1])
-                maxloc[compt] = np.argmin(ecg[left[j]:right[j] + 1])
-            maxloc[compt] = maxloc[compt] + left[j]
-            # refractory period - has proved to improve results
-            if compt > 0:
-                if (maxloc[compt] - maxloc[compt - 1] < fs * rp) & (np.abs(maxval[compt]) < np.abs(maxval[compt - 1])):
-                    maxval = np.delete(maxval, compt)
-                    maxloc = np.delete(maxloc, compt)
-                elif (maxloc[compt] - maxloc[compt - 1] < fs * rp) & (
-                        np.abs(maxval[compt]) >= np.abs(maxval[compt - 1])):
-                    maxval = np.delete(maxval, compt - 1)
-                    maxloc = np.delete(maxloc, compt - 1)
-                else:
-                    compt = compt + 1
+    def __peaks_per_lead(self, detector, *args):
+        # run the detector on every lead, in a process pool when n_pools > 1, and
+        # write the detections into one array padded with NaN for the shorter leads
+        signal = self.signal
+        fs = self.fs
+        [ecg_len, ecg_num] = np.shape(signal)
+        # column views of the live signal: the detectors take their own contiguous copy of
+        # each lead (jqrs as float32, xqrs as float64), so a transposed copy would not pay off
+        leads = [signal[:, i] for i in range(ecg_num)]
+        if self.n_pools > 1:
+            with multiprocessing.Pool(self.n_pools) as pool:
+                leads_peaks = pool.starmap(detector, [(lead, fs) + args for lead in leads])
+        else:
+            leads_peaks = (detector(lead, fs, *args) for lead in leads)
+        peaks = np.full([int(ecg_len * MAX_BPM / 60 / fs) + 8, ecg_num], np.nan)
+        max_sp = 0
+        for i, peaks_i in enumerate(leads_peaks):
+            if len(peaks_i) > len(peaks):
+                peaks = np.pad(peaks, ((0, len(peaks_i) - len(peaks)), (0, 0)), constant_values=np.nan)
+            peaks[:len(peaks_i), i] = peaks_i
+            max_sp = max(max_sp, len(peaks_i))
+        return peaks[:max_sp]
+
+
+def _calculate_xqrs(signal, fs):
+    xqrs = processing.xqrs_detect(signal.astype(np.float64), fs=fs, verbose=False)
+    return xqrs
+
+
+def _calculate_jqrs(signal, fs, thr, rp):
+    ecg = np.ascontiguousarray(signal, dtype=np.float32)  # halves the memory traffic of the streaming kernels
+    INT_NB_COEFF = int(np.round(7 * fs / 256))  # length is 30 for fs=256Hz
+    delay = math.ceil(INT_NB_COEFF / 2)
+    # differenciate, square and integrate, removing the filter delay for scanning back through ecg
+    mdfint = _mov_sum_sq_diff(ecg, INT_NB_COEFF, delay)
+    # thresholding
+    mdfint_temp = mdfint
+    mdfint_temp_ = mdfint_temp[~np.isnan(mdfint_temp)]  # exclude the NaN
+    ind_xs = int(np.round(98 / 100 * len(mdfint_temp_)))
+    en_thres = np.partition(mdfint_temp_, ind_xs)[ind_xs]
+    poss_reg = mdfint > thr * en_thres
+    # search back
+    indAboveThreshold = np.where(poss_reg)[0]  # indices of samples above threshold
+    RRv = np.diff(indAboveThreshold)  # compute RRv (in samples)
+    medRRv = np.median(RRv[RRv > 0.01 * fs])
+    indMissedBeat = np.where(RRv > 1.5 * medRRv)[0]  # missed a peak?
+    # find interval onto which a beat might have been missed
+    indStart = indAboveThreshold[indMissedBeat]
+    indEnd = indAboveThreshold[indMissedBeat + 1]
+    # look for a peak on these (disjoint) intervals by lowering the energy threshold
+    marks = np.zeros(len(poss_reg) + 1, dtype=int)
+    marks[indStart] += 1
+    marks[indEnd] -= 1
+    missed = np.cumsum(marks[:-1]) > 0
+    poss_reg[missed] = mdfint[missed] > (0.25 * thr * en_thres)
+    # find indices into boudaries of each segment
+    edge = np.empty_like(poss_reg)
+    edge[0] = False
+    edge[1:] = poss_reg[:-1]  # previous sample, False before the start
+    left = np.flatnonzero(poss_reg & ~edge)
+    edge[-1] = False
+    edge[:-1] = poss_reg[1:]  # next sample, False after the end
+    right = np.flatnonzero(poss_reg & ~edge)
+    loc = _segment_argmax(np.abs(ecg), left, right)
+    sign = np.median(ecg[loc])
+    # if sign is positive then look for positive peaks, otherwise for negative peaks
+    sgn = 1.0 if sign > 0 else -1.0
+    maxloc = _segment_argmax(sgn * ecg, left, right)
+    # loop through all possibilities
+    maxloc = _jqrs_merge(maxloc, ecg[maxloc], math.ceil(fs * rp))
+    qrs_pos = maxloc  # datapoints QRS positions
+    return qrs_pos
+
+
+@njit(cache=True)
+def _mov_sum_sq_diff(ecg, n_coeff, delay):
+    # moving sum over n_coeff samples of the squared first difference (one datapoint shorter),
+    # written delay samples earlier with wrap around, as np.roll(..., -delay) would.
+    # As with lfilter, a NaN (inf) only makes the windows that contain it NaN (inf): the
+    # running sum holds the finite terms and the non-finite ones are counted apart
+    n = len(ecg) - 1
+    out = np.empty(n, ecg.dtype)
+    s = 0.0
+    n_nan = 0
+    n_inf = 0
+    for i in range(n):
+        d = ecg[i + 1] - ecg[i]
+        sq = d * d
+        if np.isfinite(sq):
+            s += sq
+        elif np.isnan(sq):
+            n_nan += 1
+        else:
+            n_inf += 1
+        if i >= n_coeff:
+            # the squared difference leaving the window is recomputed instead of buffered
+            d = ecg[i + 1 - n_coeff] - ecg[i - n_coeff]
+            sq = d * d
+            if np.isfinite(sq):
+                s -= sq
+            elif np.isnan(sq):
+                n_nan -= 1
             else:
-                # if first peak then increment
-                compt = compt + 1
-        qrs_pos = maxloc  # datapoints QRS positions
-
-        if fl:
-            os.chdir(cwd)
-        tmpdirname.cleanup()
-        return qrs_pos
\ No newline at end of file
+                n_inf -= 1
+        j = i - delay
+        if j < 0:
+            j += n
+        if n_nan > 0:
+            out[j] = np.nan
+        elif n_inf > 0:
+            out[j] = np.inf
+        else:
+            out[j] = s
+    return out
+
+
+def _mov_sum_sq_diff_numpy(ecg, n_coeff, delay):
+    # numpy version of _mov_sum_sq_diff, used when numba is not available
+    sq = np.square(np.diff(ecg))
+    finite = np.isfinite(sq)
+    csum = np.cumsum(np.where(finite, sq, 0), dtype=np.float64)
+    csum[n_coeff:] -= csum[:-n_coeff].copy()  # moving sum, as lfilter(np.ones(n_coeff), 1, ...)
+    if not finite.all():
+        # as with lfilter, only the windows holding a NaN (inf) are NaN (inf)
+        for bad, value in ((np.isinf(sq), np.inf), (np.isnan(sq), np.nan)):
+            count = np.cumsum(bad)
+            count[n_coeff:] -= count[:-n_coeff].copy()
+            csum[count > 0] = value
+    return np.roll(csum.astype(ecg.dtype), -delay)
+
+
+if not HAS_NUMBA:
+    _mov_sum_sq_diff = _mov_sum_sq_diff_numpy
+
+
+def _segment_argmax(x, left, right):
+    # position of the first maximum of x on every segment [left[j], right[j]],
+    # or of its first NaN if it has one, as np.argmax
+    if len(left) == 0:
+        return np.zeros(0, dtype=int)
+    bounds = np.empty(2 * len(left), dtype=int)
+    bounds[0::2] = left
+    bounds[1::2] = right + 1
+    if bounds[-1] == len(x):
+        bounds = bounds[:-1]  # the last segment runs up to the end of the signal
+    seg_max = np.maximum.reduceat(x, bounds)[0::2]
+    lengths = right - left + 1
+    labels = np.repeat(np.arange(len(left)), lengths)
+    pos = np.arange(len(labels)) + np.repeat(left - np.cumsum(lengths) + lengths, lengths)
+    x_pos = x[pos]
+    hits = np.flatnonzero((x_pos == seg_max[labels]) | np.isnan(x_pos))  # a segment with a NaN has a NaN maximum
+    first = np.concatenate(([True], np.diff(labels[hits]) > 0))
+    return pos[hits[first]]
+
+
+@njit(cache=True)
+def _jqrs_merge(maxloc, maxval, fs_rp):
+    # refractory period - has proved to improve results
+    n = len(maxloc)
+    qrs_loc = np.empty(n, np.int64)
+    qrs_val = np.empty(n)
+    compt = 0
+    for j in range(n):
+        if compt > 0 and maxloc[j] - qrs_loc[compt - 1] < fs_rp:
+            # keep the larger peak; a NaN peak compares neither way and is kept as a new one
+            if abs(maxval[j]) < abs(qrs_val[compt - 1]):
+                continue
+            if abs(maxval[j]) >= abs(qrs_val[compt - 1]):
+                compt -= 1
+        qrs_loc[compt] = maxloc[j]
+        qrs_val[compt] = maxval[j]
+        compt += 1
+    return qrs_loc[:compt]
@@ -7,20 +7,20 @@ import numpy as np
 
 
 def epltd_all(signal, fs, tmpdirname=None):
-    fs = np.uint(fs)
-    five_sec = int(5 * fs)
+    fs = int(fs)
+    five_sec = 5 * fs
     pad = signal[0:five_sec]
     signal_pad = np.concatenate((pad, signal))
     my_path = str(pathlib.Path(__file__).parent.resolve())
     with tempfile.TemporaryDirectory() as tmpdirname:
-        os.chdir(tmpdirname)
         wfdb.wrsamp(
             record_name="temp",
-            fs=int(fs),
+            fs=fs,
             units=["mV"],
             sig_name=["V1"],
             p_signal=signal_pad.reshape(-1, 1),
             fmt=["16"],
+            write_dir=tmpdirname,
         )
 
         prog_dir = my_path + "/epltd_all"
@@ -38,5 +38,5 @@ def epltd_all(signal, fs, tmpdirname=None):
         if os.name == "nt":
             command = "wsl " + command
         os.system(command)
-        peaks = wfdb.rdann("temp", "epltd0").sample - five_sec
+        peaks = wfdb.rdann(os.path.join(tmpdirname, "temp"), "epltd0").sample - five_sec
     return peaks
@@ -1,6 +1,7 @@
 import tempfile
 import platform
 import os, sys, stat
+import subprocess
 import numpy as np
 import scipy.io as spio
 import pathlib
@@ -9,10 +10,9 @@ import pathlib
 def wavdet(signal, fs, peaks, matlab_pat):
     my_path = str(pathlib.Path(__file__).parent.resolve())
     tmpdirname = tempfile.TemporaryDirectory()
-    os.chdir(tmpdirname.name)
 
-    np.savetxt("peaks.txt", peaks)
-    np.savetxt("signal.txt", signal)
+    np.savetxt(os.path.join(tmpdirname.name, "peaks.txt"), peaks)
+    np.savetxt(os.path.join(tmpdirname.name, "signal.txt"), signal)
     if platform.system() == "Linux":
         wavedet_dir = my_path + "/run_peak_det_2023.sh"
         for root, dirs, files in os.walk(my_path):
@@ -24,12 +24,12 @@ def wavdet(signal, fs, peaks, matlab_pat):
         command = " ".join(
             [wavedet_dir, matlab_pat, '"signal.txt" "peaks.txt"', str(fs)]
         )
-        os.system(command)
+        subprocess.run(command, shell=True, cwd=tmpdirname.name)
         fiducials_mat = spio.loadmat(tmpdirname.name + "/output.mat")
     if platform.system() == "Windows":
         wavedet_dir = my_path + "//peak_det_2023.exe"
         command = " ".join([wavedet_dir, '"signal.txt" "peaks.txt" ', str(fs)])
-        os.system(command)
+        subprocess.run(command, shell=True, cwd=tmpdirname.name)
         fiducials_mat = spio.loadmat(tmpdirname.name + "//output.mat")
 
     return fiducials_mat, tmpdirname
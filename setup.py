@@ -37,4 +37,5 @@ setuptools.setup(
     include_package_data=True,
     python_requires=">=3.6",
     install_requires=["numpy", "mne"],
+    extras_require={"fast": ["numba"]},
 )
@@ -0,0 +1,129 @@
+import numpy as np
+import pytest
+import scipy.signal as sc_signal
+
+from pecg.ecg.FiducialPoints import FiducialPoints, _jqrs_merge, _mov_sum_sq_diff, _mov_sum_sq_diff_numpy, \
+    _segment_argmax
+
+__author__ = "SheinaG"
+__copyright__ = "SheinaG"
+__license__ = "MIT"
+
+
+def _synthetic_ecg(fs, duration, seed):
+    # gaussian QRS-like beats every 0.6 to 1.1 s, on top of noise and baseline wander
+    rng = np.random.default_rng(seed)
+    n = int(fs * duration)
+    width = int(0.02 * fs)
+    ecg = 0.05 * rng.standard_normal(n) + 0.2 * np.sin(2 * np.pi * 0.3 * np.arange(n) / fs)
+    beats = np.cumsum(rng.uniform(0.6, 1.1, int(2 * duration)) * fs).astype(int)
+    for beat in beats[(beats > 3 * width) & (beats < n - 3 * width)]:
+        shape = np.exp(-0.5 * (np.arange(-3 * width, 3 * width) / width) ** 2)
+        ecg[beat - 3 * width:beat + 3 * width] += rng.uniform(0.8, 1.5) * shape
+    return ecg
+
+
+def test_segment_argmax():
+    """Every segment gives the position of its first maximum, or of its first NaN, as np.argmax"""
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        x = rng.integers(0, 5, 60).astype(float)
+        x[rng.random(60) < 0.05] = np.nan
+        bounds = np.sort(rng.choice(60, 2 * rng.integers(1, 10), replace=False))
+        left, right = bounds[::2], bounds[1::2]
+        expected = [l + np.argmax(x[l:r + 1]) for l, r in zip(left, right)]
+        assert np.array_equal(_segment_argmax(x, left, right), expected)
+
+
+def test_jqrs_merge_refractory():
+    """Within the refractory period only the larger peak is kept"""
+    maxloc = np.array([10, 40, 60, 200, 220])
+    assert np.array_equal(_jqrs_merge(maxloc, np.array([1.0, 3.0, 2.0, -2.0, 1.0]), 63), [40, 200])
+
+
+def test_jqrs_merge_nan_peak():
+    """A NaN peak is kept inside the refractory period, as in the original loop"""
+    maxloc = np.array([10, 21, 30, 200])
+    assert np.array_equal(_jqrs_merge(maxloc, np.array([1.0, np.nan, 2.0, 1.0]), 63), [10, 21, 30, 200])
+
+
+def _lfilter_mov_sum_sq_diff(ecg, n_coeff, delay):
+    # the original differentiate, square and integrate chain of jqrs
+    intecg = sc_signal.lfilter(np.ones(n_coeff), 1, np.square(np.diff(ecg.astype(np.float64))))
+    return np.roll(intecg, -delay)
+
+
+def test_mov_sum_sq_diff_nan():
+    """NaN and inf only spoil the integration windows that contain them, as with lfilter"""
+    rng = np.random.default_rng(0)
+    ecg = rng.standard_normal(2000).astype(np.float32)
+    ecg[[700, 1990]] = np.nan
+    ecg[1200] = np.inf
+    expected = _lfilter_mov_sum_sq_diff(ecg, 30, 15)
+    assert np.allclose(_mov_sum_sq_diff(ecg, 30, 15), expected, rtol=1e-4, equal_nan=True)
+    assert np.allclose(_mov_sum_sq_diff_numpy(ecg, 30, 15), expected, rtol=1e-4, equal_nan=True)
+
+
+def test_jqrs_nan_stretch():
+    """A NaN stretch is left out of the energy threshold instead of making it NaN"""
+    fs = 250
+    ecg = _synthetic_ecg(fs, 60, 0)
+    clean = FiducialPoints(ecg, fs).jqrs()
+    ecg[30 * fs:30 * fs + int(0.03 * len(ecg))] = np.nan
+    peaks = FiducialPoints(ecg, fs).jqrs()
+    assert len(peaks) >= 0.9 * len(clean)
+
+
+@pytest.mark.parametrize("fs", [250, 500, 1000])
+def test_jqrs_search_back(fs):
+    """A beat below the energy threshold is found by the search-back at the lowered threshold"""
+    n = 30 * fs
+    beats = np.arange(1, 29) * fs
+    amp = np.ones(len(beats))
+    amp[14] = 0.6  # about half the energy threshold, twice the lowered one
+    shape = np.exp(-0.5 * ((np.arange(n) - beats[:, None]) / (0.015 * fs)) ** 2)
+    ecg = amp @ shape + 0.01 * np.sin(2 * np.pi * 0.25 * np.arange(n) / fs)
+    peaks = FiducialPoints(ecg, fs).jqrs()
+    assert len(peaks) == len(beats)
+    assert np.all(np.abs(peaks - beats) <= 0.02 * fs)
+    ecg -= (0.6 - 0.3) * shape[14]  # below the lowered threshold as well
+    assert len(FiducialPoints(ecg, fs).jqrs()) == len(beats) - 1
+
+
+def test_epltd_cached_until_signal_assigned(monkeypatch):
+    """epltd runs the detector once per assigned signal"""
+    calls = []
+
+    def fake_epltd_all(signal, fs):
+        calls.append(signal)
+        return np.array([len(calls)])
+
+    monkeypatch.setattr("pecg.ecg.FiducialPoints.epltd_all", fake_epltd_all)
+    fs = 250
+    fp = FiducialPoints(_synthetic_ecg(fs, 10, 0), fs)
+    assert np.array_equal(fp.epltd(), [1])
+    assert np.array_equal(fp.epltd(), [1])
+    fp.signal = _synthetic_ecg(fs, 10, 1)
+    assert np.array_equal(fp.epltd(), [2])
+    assert len(calls) == 2 and calls[1] is fp.signal
+
+
+def test_peaks_pool_matches_serial():
+    """Running the leads in a process pool gives the same peaks as the serial loop"""
+    fs = 250
+    signal = np.stack([_synthetic_ecg(fs, 30, seed) for seed in range(3)], axis=1)
+    serial = FiducialPoints(signal, fs)
+    pool = FiducialPoints(signal, fs, n_pools=3)
+    assert np.array_equal(pool.jqrs(), serial.jqrs(), equal_nan=True)
+    assert np.array_equal(pool.xqrs(), serial.xqrs(), equal_nan=True)
+
+
+def test_jqrs_sees_in_place_signal_edits():
+    """The multi-lead detectors use the current content of the signal"""
+    fs = 250
+    t = np.arange(20 * fs)
+    lead = np.exp(-0.5 * (((t % fs) - fs // 2) / 5.0) ** 2)  # one beat per second
+    fp = FiducialPoints(np.stack([lead, lead], axis=1), fs)
+    assert np.sum(~np.isnan(fp.jqrs()[:, 0])) > 0
+    fp.signal[:, 0] = 0.0
+    assert np.sum(~np.isnan(fp.jqrs()[:, 0])) == 0